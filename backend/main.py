@@ -1,6 +1,6 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse
 import uvicorn
 import os
 from pathlib import Path
@@ -8,11 +8,22 @@ from typing import Optional, List
 import asyncio
 import time
 import shutil
-from PIL import Image, ImageFilter, ImageOps
+import tempfile
+import hashlib
+import math
+import uuid
+import subprocess
+import requests
+from urllib.parse import urljoin
+from PIL import Image, ImageColor, ImageFilter, ImageOps
+import numpy as np
 import yt_dlp
 import logging
 import traceback
-from threading import Lock
+from threading import Lock, Semaphore
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from starlette.concurrency import run_in_threadpool
 
 # Configure logging
@@ -20,6 +31,7 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 from rembg import remove
+from rembg.bg import alpha_matting_cutout, naive_cutout
 
 STIRLING_PDF_URL = os.getenv("STIRLING_PDF_URL")
 
@@ -28,6 +40,243 @@ def get_stirling_headers():
 
 app = FastAPI(title="Unified Tools API")
 
+# Admission control for the CPU- and bandwidth-heavy endpoints.
+# rate/burst are per client token buckets, concurrency/max_queue are per tool
+# and enforced by the handlers through admission.slot()/blocking_slot().
+ADMISSION_LIMITS = {
+    "/api/remove-background": {
+        "rate_per_minute": 10,
+        "burst": 5,
+        "concurrency": 2,
+        "max_queue": 8,
+        "max_body_bytes": 50 * 1024 * 1024,
+        "max_files": 10,
+    },
+    "/api/convert-image": {
+        "rate_per_minute": 30,
+        "burst": 10,
+        "concurrency": 4,
+        "max_queue": 16,
+        "max_body_bytes": 100 * 1024 * 1024,
+        "max_files": 20,
+    },
+    "/api/download-video": {
+        "rate_per_minute": 5,
+        "burst": 2,
+        # download_video clears DOWNLOAD_DIR and shares download_progress, so one at a time
+        "concurrency": 1,
+        "max_queue": 4,
+        "max_body_bytes": 64 * 1024,
+        "max_files": 0,
+    },
+    "/api/uploads": {
+        "rate_per_minute": 10,
+        "burst": 5,
+        "concurrency": 4,
+        "max_queue": 0,
+        "max_body_bytes": 64 * 1024,
+        "max_files": 0,
+    },
+    # Every PUT /api/uploads/{upload_id}/chunks/{index} shares this entry
+    "/api/uploads/chunks": {
+        "method": "PUT",
+        "rate_per_minute": 600,
+        "burst": 60,
+        "concurrency": 4,
+        "max_queue": 32,
+        "max_body_bytes": 32 * 1024 * 1024,
+        "max_files": 0,
+    },
+}
+OVERLOADED_RETRY_AFTER_SECONDS = 5
+MAX_TRACKED_CLIENTS = 10000
+# Only honour X-Forwarded-For when running behind a trusted reverse proxy
+TRUST_PROXY_HEADERS = os.getenv("TRUST_PROXY_HEADERS", "").lower() in ("1", "true", "yes")
+
+class TokenBucket:
+    def __init__(self, rate_per_second, capacity):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        """Take one token. Returns 0 on success, otherwise seconds until a token is available."""
+        self.refill(time.monotonic())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class AdmissionController:
+    def __init__(self, limits):
+        self.limits = limits
+        self.buckets = OrderedDict()
+        self.lock = Lock()
+        # Async handlers wait on asyncio semaphores, sync handlers (already on a worker thread) on thread ones
+        self.semaphores = {path: asyncio.Semaphore(cfg["concurrency"]) for path, cfg in limits.items()}
+        self.thread_semaphores = {path: Semaphore(cfg["concurrency"]) for path, cfg in limits.items()}
+        self.queued = {path: 0 for path in limits}
+        self.in_flight = {path: 0 for path in limits}
+        self.metrics = {
+            path: {"admitted": 0, "rate_limited": 0, "too_large": 0, "length_required": 0, "overloaded": 0}
+            for path in limits
+        }
+
+    def check_rate(self, path, client_id):
+        cfg = self.limits[path]
+        with self.lock:
+            key = (path, client_id)
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(cfg["rate_per_minute"] / 60.0, cfg["burst"])
+                self.buckets[key] = bucket
+                # Least recently seen clients go first once the table is full
+                while len(self.buckets) > MAX_TRACKED_CLIENTS:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+            return bucket.try_acquire()
+
+    def reserve(self, path):
+        """Count a caller as waiting for a tool slot, or shed it when the queue is full."""
+        cfg = self.limits[path]
+        with self.lock:
+            if self.in_flight[path] + self.queued[path] >= cfg["concurrency"] + cfg["max_queue"]:
+                self.metrics[path]["overloaded"] += 1
+                raise HTTPException(
+                    status_code=503,
+                    detail="Server busy, try again shortly",
+                    headers={"Retry-After": str(OVERLOADED_RETRY_AFTER_SECONDS)},
+                )
+            self.queued[path] += 1
+
+    def start(self, path):
+        with self.lock:
+            self.queued[path] -= 1
+            self.in_flight[path] += 1
+
+    def finish(self, path):
+        with self.lock:
+            self.in_flight[path] -= 1
+
+    def abandon(self, path):
+        with self.lock:
+            self.queued[path] -= 1
+
+    @asynccontextmanager
+    async def slot(self, path):
+        """Hold one of the tool's concurrency slots around CPU work in an async handler."""
+        self.reserve(path)
+        try:
+            await self.semaphores[path].acquire()
+        except BaseException:
+            self.abandon(path)
+            raise
+        self.start(path)
+        try:
+            yield
+        finally:
+            self.finish(path)
+            self.semaphores[path].release()
+
+    @contextmanager
+    def blocking_slot(self, path):
+        """Same as slot() for sync handlers."""
+        self.reserve(path)
+        self.thread_semaphores[path].acquire()
+        self.start(path)
+        try:
+            yield
+        finally:
+            self.finish(path)
+            self.thread_semaphores[path].release()
+
+    def record(self, path, outcome):
+        with self.lock:
+            self.metrics[path][outcome] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                path: {
+                    **self.metrics[path],
+                    "in_flight": self.in_flight[path],
+                    "queued": self.queued[path],
+                    "concurrency": self.limits[path]["concurrency"],
+                }
+                for path in self.limits
+            }
+
+admission = AdmissionController(ADMISSION_LIMITS)
+
+def get_client_id(request: Request):
+    if TRUST_PROXY_HEADERS:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+def reject(status_code, detail, retry_after=None):
+    headers = {"Retry-After": str(max(1, math.ceil(retry_after)))} if retry_after is not None else None
+    return JSONResponse(status_code=status_code, content={"detail": detail}, headers=headers)
+
+def admission_path(path):
+    """Map a request path onto its ADMISSION_LIMITS entry, if any."""
+    if path.startswith("/api/uploads/") and "/chunks/" in path:
+        return "/api/uploads/chunks"
+    return path
+
+def enforce_upload_limit(path, upload_ids):
+    """Apply an endpoint's body limit to the chunked uploads it is asked to read."""
+    max_bytes = ADMISSION_LIMITS[path]["max_body_bytes"]
+    referenced = sum(get_chunked_upload(upload_id)['size'] for upload_id in upload_ids)
+    if referenced > max_bytes:
+        admission.record(path, "too_large")
+        raise HTTPException(status_code=413, detail=f"Referenced uploads too large: limit is {max_bytes} bytes")
+
+def enforce_file_limit(path, files):
+    max_files = ADMISSION_LIMITS[path]["max_files"]
+    if len(files) > max_files:
+        admission.record(path, "too_large")
+        raise HTTPException(status_code=413, detail=f"Too many files: at most {max_files} per request")
+
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    path = admission_path(request.url.path)
+    cfg = ADMISSION_LIMITS.get(path)
+    if cfg is None or request.method != cfg.get("method", "POST"):
+        return await call_next(request)
+
+    # Decide on the declared size before any of the body is read
+    content_length = request.headers.get("content-length")
+    if content_length is None:
+        admission.record(path, "length_required")
+        return reject(411, "Content-Length header is required")
+    try:
+        declared_size = int(content_length)
+    except ValueError:
+        admission.record(path, "length_required")
+        return reject(400, "Invalid Content-Length header")
+    if declared_size > cfg["max_body_bytes"]:
+        admission.record(path, "too_large")
+        return reject(413, f"Request body too large: limit is {cfg['max_body_bytes']} bytes")
+
+    wait = admission.check_rate(path, get_client_id(request))
+    if wait:
+        admission.record(path, "rate_limited")
+        return reject(429, "Rate limit exceeded", retry_after=wait)
+
+    # Concurrency slots are taken inside the handlers around the CPU work,
+    # so a slow client uploading its body does not hold one
+    admission.record(path, "admitted")
+    return await call_next(request)
+
+
 
 # Configure CORS
 app.add_middleware(
@@ -42,6 +291,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After"],
 )
 
 # Configure logging
@@ -51,6 +301,10 @@ app.add_middleware(
 async def health_check():
     return {"status": "ok", "service": "Unified Tools API"}
 
+@app.get("/api/admission-metrics")
+async def get_admission_metrics():
+    return admission.snapshot()
+
 @app.post("/api/pdf/merge")
 def merge_pdfs(files: List[UploadFile] = File(...)):
     if not STIRLING_PDF_URL:
@@ -97,20 +351,26 @@ def merge_pdfs(files: List[UploadFile] = File(...)):
 
 @app.post("/api/pdf/split")
 def split_pdf(
-    file: UploadFile = File(...),
+    file: UploadFile = File(None),
     split_type: str = Form(...),  # 'ranges', 'pages', or 'interval'
-    split_value: str = Form(...)  # e.g., "1-3,4-6" or "2" (every 2 pages)
+    split_value: str = Form(...),  # e.g., "1-3,4-6" or "2" (every 2 pages)
+    upload_id: Optional[str] = Form(None)  # completed chunked upload to use instead of file
 ):
     if not STIRLING_PDF_URL:
         raise HTTPException(status_code=501, detail="Stirling-PDF service not configured")
+    if upload_id:
+        source_name, file_path = resolve_upload(upload_id)
+    elif file is not None:
+        source_name, file_path = file.filename, UPLOAD_DIR / file.filename
+    else:
+        raise HTTPException(status_code=400, detail="Either file or upload_id is required")
     try:
         # Save uploaded file
-        file_path = UPLOAD_DIR / file.filename
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        if not upload_id:
+            save_upload_file(file, file_path)
 
         # Call Stirling-PDF split endpoint
-        files = {"fileInput": open(file_path, "rb")}
+        files = {"fileInput": (source_name, open(file_path, "rb"), "application/pdf")}
         data = {
             "splitType": split_type,
             "splitValue": split_value
@@ -127,27 +387,30 @@ def split_pdf(
             raise HTTPException(status_code=response.status_code, detail="Failed to split PDF")
 
         # Handle multiple output files (Stirling returns a zip file)
-        output_filename = f"split_{Path(file.filename).stem}.zip"
+        output_filename = f"split_{Path(source_name).stem}.zip"
         output_path = OUTPUT_DIR / output_filename
         with open(output_path, "wb") as f:
             f.write(response.content)
 
-        # Clean up
-        files["fileInput"].close()
-        file_path.unlink()
+        # Clean up (chunked uploads are kept so they can feed other operations)
+        files["fileInput"][1].close()
+        if not upload_id:
+            file_path.unlink()
 
         return {
             "filename": output_filename,
             "url": f"/api/download/{output_filename}"
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in split_pdf: {str(e)}\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/pdf/add-watermark")
 def add_watermark(
-    file: UploadFile = File(...),
+    file: UploadFile = File(None),
     watermark_type: str = Form(...),  # 'text' or 'image'
     watermark_text: str = Form(None),
     font_size: int = Form(30),
@@ -155,17 +418,23 @@ def add_watermark(
     opacity: float = Form(0.5),
     width_spacer: int = Form(50),
     height_spacer: int = Form(50),
-    watermark_image: UploadFile = File(None)
+    watermark_image: UploadFile = File(None),
+    upload_id: Optional[str] = Form(None)  # completed chunked upload to use instead of file
 ):
     if not STIRLING_PDF_URL:
         raise HTTPException(status_code=501, detail="Stirling-PDF service not configured")
+    if upload_id:
+        source_name, pdf_path = resolve_upload(upload_id)
+    elif file is not None:
+        source_name, pdf_path = file.filename, UPLOAD_DIR / file.filename
+    else:
+        raise HTTPException(status_code=400, detail="Either file or upload_id is required")
     try:
         # Save uploaded PDF
-        pdf_path = UPLOAD_DIR / file.filename
-        with open(pdf_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        if not upload_id:
+            save_upload_file(file, pdf_path)
 
-        files = {"fileInput": open(pdf_path, "rb")}
+        files = {"fileInput": (source_name, open(pdf_path, "rb"), "application/pdf")}
         data = {
             "watermarkType": watermark_type,
             "fontSize": str(font_size),
@@ -184,8 +453,7 @@ def add_watermark(
                 raise HTTPException(status_code=400, detail="Watermark image is required")
             # Save watermark image
             watermark_path = UPLOAD_DIR / watermark_image.filename
-            with open(watermark_path, "wb") as buffer:
-                shutil.copyfileobj(watermark_image.file, buffer)
+            save_upload_file(watermark_image, watermark_path)
             files["watermarkImage"] = open(watermark_path, "rb")
 
         response = requests.post(
@@ -199,14 +467,15 @@ def add_watermark(
             raise HTTPException(status_code=response.status_code, detail="Failed to add watermark")
 
         # Save the watermarked PDF
-        output_filename = f"watermarked_{Path(file.filename).stem}.pdf"
+        output_filename = f"watermarked_{Path(source_name).stem}.pdf"
         output_path = OUTPUT_DIR / output_filename
         with open(output_path, "wb") as f:
             f.write(response.content)
 
         # Clean up
-        files["fileInput"].close()
-        pdf_path.unlink()
+        files["fileInput"][1].close()
+        if not upload_id:
+            pdf_path.unlink()
         if watermark_type == "image":
             files["watermarkImage"].close()
             watermark_path.unlink()
@@ -216,6 +485,8 @@ def add_watermark(
             "url": f"/api/download/{output_filename}"
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in add_watermark: {str(e)}\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -224,10 +495,213 @@ def add_watermark(
 UPLOAD_DIR = Path("uploads")
 OUTPUT_DIR = Path("outputs")
 DOWNLOAD_DIR = Path("downloads")
+MASK_DIR = Path("masks")
 
-for directory in [UPLOAD_DIR, OUTPUT_DIR, DOWNLOAD_DIR]:
+for directory in [UPLOAD_DIR, OUTPUT_DIR, DOWNLOAD_DIR, MASK_DIR]:
     directory.mkdir(exist_ok=True)
 
+# Resumable chunked uploads. Each upload is assembled in place under
+# CHUNKED_UPLOAD_DIR and can then be referenced by id from the tool endpoints.
+CHUNKED_UPLOAD_DIR = UPLOAD_DIR / "chunked"
+CHUNKED_UPLOAD_DIR.mkdir(exist_ok=True)
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+# Only the last chunk may be shorter than MIN_CHUNK_SIZE, which caps an upload at 8192 chunks
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = ADMISSION_LIMITS["/api/uploads/chunks"]["max_body_bytes"]
+MAX_CHUNKED_UPLOAD_SIZE = 2 * 1024 * 1024 * 1024
+# Preallocated disk across all uploads still held by the server
+MAX_CHUNKED_UPLOADS = 32
+MAX_CHUNKED_UPLOAD_BYTES = 8 * 1024 * 1024 * 1024
+MAX_CHUNKED_UPLOADS_PER_CLIENT = 4
+# Uploads (complete or not) untouched for this long are dropped, independent of MAX_AGE_SECONDS
+CHUNKED_UPLOAD_IDLE_SECONDS = 30 * 60
+
+chunked_uploads = {}
+uploads_lock = Lock()
+
+def save_upload_file(upload, path):
+    with open(path, "wb") as buffer:
+        shutil.copyfileobj(upload.file, buffer)
+
+def write_chunk(path, offset, data, expected_sha256):
+    """Verify a chunk against its checksum and write it at its offset. Returns False on mismatch."""
+    if hashlib.sha256(data).hexdigest() != expected_sha256.lower():
+        return False
+    with open(path, "r+b") as f:
+        f.seek(offset)
+        f.write(data)
+    return True
+
+def get_chunked_upload(upload_id):
+    expire_idle_uploads()
+    with uploads_lock:
+        upload = chunked_uploads.get(upload_id)
+        if upload is not None:
+            upload['last_used'] = time.monotonic()
+    if upload is None or not upload['path'].exists():
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return upload
+
+def expire_idle_uploads():
+    """Forget uploads nobody has touched for CHUNKED_UPLOAD_IDLE_SECONDS and delete their data."""
+    cutoff = time.monotonic() - CHUNKED_UPLOAD_IDLE_SECONDS
+    with uploads_lock:
+        expired = [upload for upload in chunked_uploads.values() if upload['last_used'] < cutoff]
+        for upload in expired:
+            del chunked_uploads[upload['id']]
+    for upload in expired:
+        upload['path'].unlink(missing_ok=True)
+        logger.info(f"Expired idle chunked upload {upload['id']}")
+
+def chunk_ranges(indices):
+    """Collapse sorted chunk indices into inclusive [start, end] ranges."""
+    ranges = []
+    for index in indices:
+        if ranges and ranges[-1][1] == index - 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ranges
+
+def upload_status(upload):
+    with uploads_lock:
+        received = chunk_ranges(sorted(upload['received']))
+        missing = chunk_ranges(i for i in range(upload['total_chunks']) if i not in upload['received'])
+    return {
+        "upload_id": upload['id'],
+        "filename": upload['filename'],
+        "size": upload['size'],
+        "chunk_size": upload['chunk_size'],
+        "total_chunks": upload['total_chunks'],
+        # Both as inclusive [start, end] ranges
+        "received_chunks": received,
+        "missing_chunks": missing,
+        "complete": upload['complete'],
+    }
+
+def resolve_upload(upload_id):
+    """Return (filename, path) of a completed chunked upload for use as a tool input."""
+    upload = get_chunked_upload(upload_id)
+    if not upload['complete']:
+        raise HTTPException(status_code=409, detail="Upload is not complete")
+    # Keep the upload alive while it is still being used
+    os.utime(upload['path'])
+    return upload['filename'], upload['path']
+
+@app.post("/api/uploads")
+def create_upload(
+    request: Request,
+    filename: str = Form(...),
+    size: int = Form(...),
+    chunk_size: int = Form(DEFAULT_CHUNK_SIZE)
+):
+    if size <= 0 or size > MAX_CHUNKED_UPLOAD_SIZE:
+        raise HTTPException(status_code=413, detail=f"Upload size must be between 1 and {MAX_CHUNKED_UPLOAD_SIZE} bytes")
+    if chunk_size < MIN_CHUNK_SIZE or chunk_size > MAX_CHUNK_SIZE:
+        raise HTTPException(status_code=400, detail=f"chunk_size must be between {MIN_CHUNK_SIZE} and {MAX_CHUNK_SIZE} bytes")
+
+    expire_idle_uploads()
+    client_id = get_client_id(request)
+    upload_id = uuid.uuid4().hex
+    path = CHUNKED_UPLOAD_DIR / upload_id
+    upload = {
+        'id': upload_id,
+        'filename': Path(filename).name,
+        'path': path,
+        'size': size,
+        'chunk_size': chunk_size,
+        'total_chunks': math.ceil(size / chunk_size),
+        'received': set(),
+        'complete': False,
+        'client': client_id,
+        'last_used': time.monotonic(),
+    }
+    with uploads_lock:
+        if sum(1 for u in chunked_uploads.values() if u['client'] == client_id) >= MAX_CHUNKED_UPLOADS_PER_CLIENT:
+            raise HTTPException(
+                status_code=429,
+                detail=f"At most {MAX_CHUNKED_UPLOADS_PER_CLIENT} open uploads per client",
+                headers={"Retry-After": str(CHUNKED_UPLOAD_IDLE_SECONDS)},
+            )
+        held_bytes = sum(u['size'] for u in chunked_uploads.values())
+        if len(chunked_uploads) >= MAX_CHUNKED_UPLOADS or held_bytes + size > MAX_CHUNKED_UPLOAD_BYTES:
+            raise HTTPException(
+                status_code=503,
+                detail="Too many uploads in progress, try again later",
+                headers={"Retry-After": str(OVERLOADED_RETRY_AFTER_SECONDS)},
+            )
+        chunked_uploads[upload_id] = upload
+
+    try:
+        # Preallocate so chunks can be written at their offsets in any order
+        with open(path, "wb") as f:
+            f.truncate(size)
+    except Exception:
+        with uploads_lock:
+            chunked_uploads.pop(upload_id, None)
+        raise
+    logger.info(f"Created chunked upload {upload_id} for {upload['filename']} ({size} bytes)")
+    return upload_status(upload)
+
+@app.get("/api/uploads/{upload_id}")
+async def get_upload(upload_id: str):
+    return upload_status(get_chunked_upload(upload_id))
+
+@app.delete("/api/uploads/{upload_id}")
+async def delete_upload(upload_id: str):
+    upload = get_chunked_upload(upload_id)
+    with uploads_lock:
+        chunked_uploads.pop(upload_id, None)
+    upload['path'].unlink(missing_ok=True)
+    return {"upload_id": upload_id, "deleted": True}
+
+@app.put("/api/uploads/{upload_id}/chunks/{index}")
+async def put_upload_chunk(upload_id: str, index: int, request: Request):
+    upload = get_chunked_upload(upload_id)
+    if upload['complete']:
+        raise HTTPException(status_code=409, detail="Upload is already complete")
+    if index < 0 or index >= upload['total_chunks']:
+        raise HTTPException(status_code=400, detail=f"Chunk index must be between 0 and {upload['total_chunks'] - 1}")
+    checksum = request.headers.get("x-chunk-sha256")
+    if not checksum:
+        raise HTTPException(status_code=400, detail="X-Chunk-SHA256 header is required")
+
+    offset = index * upload['chunk_size']
+    expected_length = min(upload['chunk_size'], upload['size'] - offset)
+    declared_length = request.headers.get("content-length")
+    if declared_length is not None and declared_length.isdigit() and int(declared_length) > expected_length:
+        raise HTTPException(status_code=413, detail=f"Chunk {index} must be {expected_length} bytes")
+
+    data = await request.body()
+    if len(data) != expected_length:
+        raise HTTPException(status_code=400, detail=f"Chunk {index} must be {expected_length} bytes, got {len(data)}")
+
+    # Hashing and disk writes happen off the event loop
+    async with admission.slot("/api/uploads/chunks"):
+        stored = await run_in_threadpool(write_chunk, upload['path'], offset, data, checksum)
+    if not stored:
+        raise HTTPException(status_code=422, detail=f"Checksum mismatch for chunk {index}")
+
+    with uploads_lock:
+        upload['received'].add(index)
+    return {"upload_id": upload_id, "index": index, "received": True}
+
+@app.post("/api/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str, sha256: Optional[str] = Form(None)):
+    upload = get_chunked_upload(upload_id)
+    status = upload_status(upload)
+    if status['missing_chunks']:
+        raise HTTPException(status_code=409, detail={"message": "Upload has missing chunks", "missing_chunks": status['missing_chunks']})
+
+    digest = await run_in_threadpool(file_sha256, upload['path'])
+    if sha256 and digest != sha256.lower():
+        raise HTTPException(status_code=422, detail="Checksum mismatch for assembled upload")
+
+    with uploads_lock:
+        upload['complete'] = True
+    logger.info(f"Completed chunked upload {upload_id} ({upload['size']} bytes)")
+    return {**upload_status(upload), "sha256": digest}
+
 def format_speed(bytes_per_sec):
     if not bytes_per_sec:
         return "0 B/s"
@@ -270,35 +744,134 @@ download_progress = {
 }
 progress_lock = Lock()
 
+BACKGROUND_OUTPUT_FORMATS = ('png', 'webp', 'mask')
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_or_create_mask(image, mask_id):
+    """Return (mask, cached) for the image, running rembg only on a cache miss."""
+    mask_path = MASK_DIR / f"{mask_id}.png"
+    if mask_path.exists():
+        try:
+            with Image.open(mask_path) as cached:
+                mask = cached.convert('L')
+            if mask.size == image.size:
+                # Refresh mtime so the cleanup task keeps recently used masks around
+                os.utime(mask_path)
+                return mask, True
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable cached mask {mask_path}: {e}")
+
+    mask = remove(image, only_mask=True).convert('L')
+    # Write to a unique temp file first so concurrent requests never read a partial mask
+    with tempfile.NamedTemporaryFile(dir=MASK_DIR, prefix=f"{mask_id}.", suffix=".tmp", delete=False) as tmp:
+        tmp_path = Path(tmp.name)
+        try:
+            mask.save(tmp, 'PNG', compress_level=1)
+        except Exception:
+            tmp.close()
+            tmp_path.unlink(missing_ok=True)
+            raise
+    os.replace(tmp_path, mask_path)
+    return mask, False
+
+def composite_from_mask(image, mask, background_color=None, alpha_matting=False,
+                        foreground_threshold=240, background_threshold=10, erode_size=10):
+    if alpha_matting:
+        try:
+            cutout = alpha_matting_cutout(image, mask, foreground_threshold, background_threshold, erode_size)
+        except ValueError:
+            # Same fallback rembg uses when the trimap ends up empty
+            cutout = naive_cutout(image, mask)
+    else:
+        cutout = naive_cutout(image, mask)
+
+    if background_color:
+        background = Image.new('RGBA', cutout.size, ImageColor.getrgb(background_color))
+        cutout = Image.alpha_composite(background, cutout.convert('RGBA')).convert('RGB')
+    return cutout
+
 @app.post("/api/remove-background")
-async def remove_background_handler(files: List[UploadFile] = File(...)):
+async def remove_background_handler(
+    files: List[UploadFile] = File(...),
+    output_format: str = Form("png"),  # 'png', 'webp' or 'mask'
+    background_color: Optional[str] = Form(None),  # e.g. "#ffffff"; transparent when omitted
+    alpha_matting: bool = Form(False),
+    alpha_matting_foreground_threshold: int = Form(240),
+    alpha_matting_background_threshold: int = Form(10),
+    alpha_matting_erode_size: int = Form(10),
+    compress_level: int = Form(6),  # PNG zlib level, 0 (fastest) - 9 (smallest)
+    quality: int = Form(90)  # WebP quality
+):
+    output_format = output_format.lower()
+    if output_format not in BACKGROUND_OUTPUT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported output format: {output_format}")
+    if not 0 <= compress_level <= 9:
+        raise HTTPException(status_code=400, detail="compress_level must be between 0 and 9")
+    if background_color:
+        try:
+            ImageColor.getrgb(background_color)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Invalid background color: {background_color}")
+    enforce_file_limit("/api/remove-background", files)
+
     try:
         output_files = []
         for file in files:
             file_path = UPLOAD_DIR / file.filename
             try:
-                # Save uploaded file
-                with open(file_path, "wb") as buffer:
-                    shutil.copyfileobj(file.file, buffer)
+                # Save uploaded file without blocking the event loop
+                await run_in_threadpool(save_upload_file, file, file_path)
                 
                 # Process image in a separate thread to avoid blocking the FastAPI event loop
                 def process_image(fp, out_p):
+                    mask_id = file_sha256(fp)
                     with Image.open(fp) as input_image:
                         logger.info(f"Input image format: {input_image.format}, mode: {input_image.mode}")
-                        # Remove background
-                        result = remove(input_image)
-                        logger.info(f"Result mode: {result.mode}")
-                        # Always save as PNG to preserve transparency
-                        result.save(str(out_p), 'PNG', optimize=True)
+                        image = ImageOps.exif_transpose(input_image).convert('RGB')
+
+                    mask, cached = load_or_create_mask(image, mask_id)
+                    logger.info(f"Mask {mask_id[:12]} {'loaded from cache' if cached else 'computed'}")
+
+                    if output_format == 'mask':
+                        mask.save(str(out_p), 'PNG', compress_level=compress_level)
+                        return mask_id, cached
 
-                output_filename = f"nobg_{Path(file.filename).stem}.png"
+                    result = composite_from_mask(
+                        image,
+                        mask,
+                        background_color=background_color,
+                        alpha_matting=alpha_matting,
+                        foreground_threshold=alpha_matting_foreground_threshold,
+                        background_threshold=alpha_matting_background_threshold,
+                        erode_size=alpha_matting_erode_size,
+                    )
+                    logger.info(f"Result mode: {result.mode}")
+                    if output_format == 'webp':
+                        result.save(str(out_p), 'WEBP', quality=quality, method=4)
+                    else:
+                        result.save(str(out_p), 'PNG', compress_level=compress_level)
+                    return mask_id, cached
+
+                if output_format == 'mask':
+                    output_filename = f"mask_{Path(file.filename).stem}.png"
+                else:
+                    output_filename = f"nobg_{Path(file.filename).stem}.{output_format}"
                 output_path = OUTPUT_DIR / output_filename
                 
-                await run_in_threadpool(process_image, file_path, output_path)
+                async with admission.slot("/api/remove-background"):
+                    mask_id, cached = await run_in_threadpool(process_image, file_path, output_path)
                 
                 output_files.append({
                     "filename": output_filename,
-                    "url": f"/api/download/{output_filename}"
+                    "url": f"/api/download/{output_filename}",
+                    "mask_id": mask_id,
+                    "mask_cached": cached
                 })
             finally:
                 # Always clean up the uploaded temporary source file
@@ -309,84 +882,227 @@ async def remove_background_handler(files: List[UploadFile] = File(...)):
                     logger.warning(f"Failed to delete temp upload {file_path}: {ex}")
         
         return {"message": "Background removal processed", "files": output_files}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in remove_background: {str(e)}\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Clockwise rotations that can be done as lossless transposes
+RIGHT_ANGLE_TRANSPOSES = {
+    90: Image.Transpose.ROTATE_270,
+    180: Image.Transpose.ROTATE_180,
+    270: Image.Transpose.ROTATE_90,
+}
+
+# Neighbourhood filters are left to Pillow's C implementations
+SPATIAL_FILTERS = {
+    'blur': lambda: ImageFilter.GaussianBlur(2),
+    'sharpen': lambda: ImageFilter.UnsharpMask(radius=2, percent=150, threshold=3),
+}
+
+def rotated_size(size, rot):
+    w, h = size
+    if rot in (90, 270):
+        return h, w
+    if rot in (0, 180):
+        return w, h
+    angle = math.radians(rot)
+    cos_a, sin_a = abs(math.cos(angle)), abs(math.sin(angle))
+    return math.ceil(w * cos_a + h * sin_a), math.ceil(w * sin_a + h * cos_a)
+
+def normalised_mode(img):
+    """Mode the pixel step works in: L, LA, RGB or RGBA."""
+    if img.mode in ('L', 'LA', 'RGB', 'RGBA'):
+        return img.mode
+    if img.mode == '1':
+        return 'L'
+    has_alpha = img.mode in ('PA', 'La', 'RGBa') or 'transparency' in img.info
+    return 'RGBA' if has_alpha else 'RGB'
+
+def plan_conversion(img, fmt, w, h, maintain_ratio, filt, rot, brightness=1.0, contrast=1.0):
+    """Plan the conversion steps as a list of (op, arg) tuples.
+
+    Colour and alpha work is fused into a single 'pixels' step, right-angle
+    rotations become transposes, and a downscale is moved ahead of every
+    other step (except a free-angle rotation) so filters run on fewer pixels.
+    A missing width or height is left as None and filled in from the image
+    when the resize runs.
+    """
+    rot = rot % 360
+    right_angle = rot in RIGHT_ANGLE_TRANSPOSES
+    steps = []
+
+    if rot and not right_angle:
+        steps.append(('rotate', rot))
+
+    resize_step = None
+    downscale = False
+    if w or h:
+        # Free-angle sizes are estimates; they only decide where the resize goes
+        src_w, src_h = rotated_size(img.size, rot)
+        target_w = w if w else src_w
+        target_h = h if h else src_h
+        if maintain_ratio:
+            # thumbnail() never enlarges, so a box at least as big as the image is a no-op
+            downscale = target_w < src_w or target_h < src_h
+            if downscale:
+                resize_step = ('thumbnail', (w, h))
+        else:
+            downscale = target_w * target_h < src_w * src_h
+            resize_step = ('resize', (w, h))
+
+    if resize_step and downscale:
+        op, (target_w, target_h) = resize_step
+        if right_angle and rot != 180:
+            # Resizing before the transpose, so the box is in pre-rotation axes
+            target_w, target_h = target_h, target_w
+        steps.append((op, (target_w, target_h)))
+
+    if right_angle:
+        steps.append(('transpose', RIGHT_ANGLE_TRANSPOSES[rot]))
+
+    has_alpha = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+    drop_alpha = fmt in ('JPEG', 'JPG') and (has_alpha or img.mode == 'P')
+    needs_normalised_mode = filt in SPATIAL_FILTERS and img.mode not in ('L', 'LA', 'RGB', 'RGBA')
+    if filt == 'grayscale' or brightness != 1.0 or contrast != 1.0 or drop_alpha or needs_normalised_mode:
+        if img.mode in ('P', '1'):
+            # Pillow resamples P and 1 images with NEAREST, so convert before any resize
+            steps.insert(0, ('convert', normalised_mode(img)))
+        steps.append(('pixels', {
+            'grayscale': filt == 'grayscale',
+            'brightness': brightness,
+            'contrast': contrast,
+            'drop_alpha': drop_alpha,
+        }))
+
+    if filt in SPATIAL_FILTERS:
+        steps.append(('filter', filt))
+
+    if resize_step and not downscale:
+        steps.append(resize_step)
+
+    return steps
+
+def apply_pixel_ops(img, grayscale=False, brightness=1.0, contrast=1.0, drop_alpha=False):
+    """Run grayscale, brightness/contrast and alpha removal as one NumPy pass."""
+    if img.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+        img = img.convert(normalised_mode(img))
+
+    arr = np.asarray(img)
+    has_alpha = img.mode in ('LA', 'RGBA')
+    color = arr[..., :-1] if has_alpha else arr
+    if color.ndim == 3 and color.shape[-1] == 1:
+        color = color[..., 0]
+
+    luma = None
+    if grayscale or contrast != 1.0:
+        # Pillow's C conversion gives the exact RGB -> L luma in a one-byte-per-pixel buffer
+        luma = img if img.mode == 'L' else img.convert('L')
+    if grayscale:
+        color = np.asarray(luma)
+
+    if brightness != 1.0 or contrast != 1.0:
+        # Fold both enhancements into one affine lookup table (ImageEnhance semantics)
+        mean = 0
+        if luma is not None:
+            histogram = luma.histogram()
+            mean = int(sum(value * count for value, count in enumerate(histogram)) / max(1, sum(histogram)) + 0.5)
+        scale = brightness * contrast
+        offset = brightness * mean * (1.0 - contrast)
+        lut = np.clip(np.arange(256, dtype=np.float32) * scale + offset + 0.5, 0, 255).astype(np.uint8)
+        color = lut[color]
+
+    if has_alpha and not drop_alpha:
+        channels = 1 if color.ndim == 2 else color.shape[-1]
+        out = np.empty(color.shape[:2] + (channels + 1,), dtype=np.uint8)
+        out[..., :-1] = color if color.ndim == 3 else color[..., None]
+        out[..., -1] = arr[..., -1]
+    else:
+        out = np.ascontiguousarray(color)
+
+    return Image.fromarray(out)
+
+def run_conversion_plan(img, steps):
+    for op, arg in steps:
+        if op == 'rotate':
+            # Pillow rotates counter-clockwise, so negative rot for clockwise
+            img = img.rotate(-arg, expand=True)
+        elif op == 'transpose':
+            img = img.transpose(arg)
+        elif op == 'convert':
+            img = img.convert(arg)
+        elif op in ('thumbnail', 'resize'):
+            w, h = arg
+            target = (w if w else img.width, h if h else img.height)
+            if op == 'thumbnail':
+                img.thumbnail(target, Image.Resampling.LANCZOS)
+                logger.info(f"Resized (thumbnail) to: {img.size}")
+            else:
+                img = img.resize(target, Image.Resampling.LANCZOS)
+                logger.info(f"Resized (absolute) to: {img.size}")
+        elif op == 'pixels':
+            img = apply_pixel_ops(img, **arg)
+        elif op == 'filter':
+            img = img.filter(SPATIAL_FILTERS[arg]())
+    return img
+
 @app.post("/api/convert-image")
 async def convert_image(
-    files: List[UploadFile] = File(...),
+    files: List[UploadFile] = File(None),
     format: str = Form(...),
     width: Optional[int] = Form(None),
     height: Optional[int] = Form(None),
     quality: int = Form(90),
     maintain_aspect_ratio: bool = Form(True),
     strip_metadata: bool = Form(True),
-    filter_type: str = Form("none"),
-    rotation: int = Form(0)
+    filter_type: str = Form("none"),  # 'none', 'grayscale', 'blur' or 'sharpen'
+    rotation: int = Form(0),
+    brightness: float = Form(1.0),  # 1.0 leaves the image unchanged
+    contrast: float = Form(1.0),
+    upload_ids: List[str] = Form(None)  # completed chunked uploads to convert alongside files
 ):
+    if brightness < 0 or contrast < 0:
+        raise HTTPException(status_code=400, detail="brightness and contrast must not be negative")
+    inputs = [(file, None) for file in files or []] + [(None, upload_id) for upload_id in upload_ids or []]
+    if not inputs:
+        raise HTTPException(status_code=400, detail="Either files or upload_ids are required")
+    enforce_file_limit("/api/convert-image", inputs)
+    enforce_upload_limit("/api/convert-image", upload_ids or [])
+
     try:
-        logger.info(f"Converting images. Format: {format}, Width: {width}, Height: {height}, Quality: {quality}, MaintainRatio: {maintain_aspect_ratio}, Strip: {strip_metadata}, Filter: {filter_type}, Rotation: {rotation}")
+        logger.info(f"Converting images. Format: {format}, Width: {width}, Height: {height}, Quality: {quality}, MaintainRatio: {maintain_aspect_ratio}, Strip: {strip_metadata}, Filter: {filter_type}, Rotation: {rotation}, Brightness: {brightness}, Contrast: {contrast}")
         output_files = []
         
-        for file in files:
-            file_path = UPLOAD_DIR / file.filename
+        for file, upload_id in inputs:
+            if upload_id:
+                source_name, file_path = resolve_upload(upload_id)
+            else:
+                source_name, file_path = file.filename, UPLOAD_DIR / file.filename
             try:
-                # Save uploaded file
-                with open(file_path, "wb") as buffer:
-                    shutil.copyfileobj(file.file, buffer)
-                
-                logger.info(f"File saved to {file_path}")
+                # Save uploaded file without blocking the event loop
+                if not upload_id:
+                    await run_in_threadpool(save_upload_file, file, file_path)
+                    logger.info(f"File saved to {file_path}")
                 
                 # Perform image loading, resizing, and saving in a threadpool to prevent blocking the event loop
                 def process_conversion(fp, out_p, fmt, w, h, qual, maintain_ratio, strip_meta, filt, rot):
                     with Image.open(fp) as img:
                         logger.info(f"Original image size: {img.size}")
-                        
-                        # Handle rotation
-                        if rot != 0:
-                            # Pillow rotates counter-clockwise, so negative rot for clockwise
-                            img = img.rotate(-rot, expand=True)
-                        
-                        # Handle filters
-                        if filt == "grayscale":
-                            img = ImageOps.grayscale(img)
-                        elif filt == "blur":
-                            # Convert to RGB before blurring if it has a palette to avoid errors
-                            if img.mode == 'P':
-                                img = img.convert('RGB')
-                            img = img.filter(ImageFilter.GaussianBlur(2))
-                        
-                        # Strip metadata (by just not passing the info dict when saving, but we can explicitly clear it)
-                        if strip_meta:
-                            img.info.pop('exif', None)
-                        else:
-                            # retain exif if possible, though Pillow loses it by default unless explicitly saved
-                            pass
-                            
-                        # Resize
-                        if w or h:
-                            if maintain_ratio:
-                                # Provide the box it should fit into
-                                target_w = w if w else img.width
-                                target_h = h if h else img.height
-                                img.thumbnail((target_w, target_h), Image.Resampling.LANCZOS)
-                                logger.info(f"Resized (thumbnail) to: {img.size}")
-                            else:
-                                target_w = w if w else img.width
-                                target_h = h if h else img.height
-                                img = img.resize((target_w, target_h), Image.Resampling.LANCZOS)
-                                logger.info(f"Resized (absolute) to: {img.size}")
-                        
+
                         format_upper = fmt.upper()
                         save_kwargs = {}
                         
                         if format_upper == 'JPG':
                             format_upper = 'JPEG'
-                        
-                        # Strip EXIF info properly if explicitly requested, else attempt to keep it
+
+                        # Grab EXIF up front; steps that build a new image do not carry img.info over
                         if not strip_meta and 'exif' in img.info:
                             save_kwargs['exif'] = img.info['exif']
+
+                        steps = plan_conversion(img, format_upper, w, h, maintain_ratio, filt, rot, brightness, contrast)
+                        logger.info(f"Conversion plan: {[op for op, _ in steps]}")
+                        img = run_conversion_plan(img, steps)
                             
                         if format_upper == 'PNG':
                             save_kwargs['optimize'] = True
@@ -408,24 +1124,27 @@ async def convert_image(
                         img.save(str(out_p), format=format_upper, **save_kwargs)
                         logger.info("Save completed")
 
-                output_filename = f"converted_{Path(file.filename).stem}.{format.lower()}"
+                output_filename = f"converted_{Path(source_name).stem}.{format.lower()}"
                 output_path = OUTPUT_DIR / output_filename
                 
-                await run_in_threadpool(process_conversion, file_path, output_path, format, width, height, quality, maintain_aspect_ratio, strip_metadata, filter_type, rotation)
+                async with admission.slot("/api/convert-image"):
+                    await run_in_threadpool(process_conversion, file_path, output_path, format, width, height, quality, maintain_aspect_ratio, strip_metadata, filter_type, rotation)
                 
                 output_files.append({
                     "filename": output_filename,
                     "url": f"/api/download/{output_filename}"
                 })
             finally:
-                # Always clean up the uploaded temporary source file
+                # Always clean up the uploaded temporary source file; chunked uploads are kept for reuse
                 try:
-                    if file_path.exists():
+                    if not upload_id and file_path.exists():
                         file_path.unlink()
                 except Exception as ex:
                     logger.warning(f"Failed to delete temp upload {file_path}: {ex}")
         
         return {"message": "Image conversion processed", "files": output_files}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in convert_image: {str(e)}\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -486,6 +1205,122 @@ async def get_download_progress():
     with progress_lock:
         return download_progress
 
+# Relative cost of each video codec family, so clients can trade file size
+# against decode cost. relative_bitrate is the bitrate needed for similar
+# quality compared to H.264.
+CODEC_HINTS = {
+    'av1': {'efficiency': 'best', 'relative_bitrate': 0.6, 'decode_cost': 'high',
+            'note': 'Smallest files, but software decoding is slow on older devices'},
+    'h265': {'efficiency': 'high', 'relative_bitrate': 0.65, 'decode_cost': 'medium',
+             'note': 'Small files, limited browser support'},
+    'vp9': {'efficiency': 'high', 'relative_bitrate': 0.75, 'decode_cost': 'medium',
+            'note': 'Good compression, plays in all modern browsers'},
+    'h264': {'efficiency': 'baseline', 'relative_bitrate': 1.0, 'decode_cost': 'low',
+             'note': 'Largest files, hardware decoding almost everywhere'},
+}
+# Most widely playable first, used to break ties between otherwise equal formats
+CODEC_PLAYABILITY = ('h264', 'vp9', 'h265', 'av1')
+CONTAINER_FAMILIES = {'mp4': 'mp4', 'm4a': 'mp4', 'mov': 'mp4', 'webm': 'webm', 'weba': 'webm'}
+# download_video merges into mp4
+MERGE_CONTAINER = 'mp4'
+
+def codec_family(vcodec):
+    vcodec = (vcodec or '').lower()
+    if vcodec.startswith(('av01', 'av1')):
+        return 'av1'
+    if vcodec.startswith(('vp09', 'vp9')):
+        return 'vp9'
+    if vcodec.startswith(('avc', 'h264')):
+        return 'h264'
+    if vcodec.startswith(('hev', 'hvc', 'h265')):
+        return 'h265'
+    return vcodec.split('.')[0] or 'unknown'
+
+def estimate_format_size(f, duration):
+    """Reported size if known, otherwise bitrate (kbit/s) x duration."""
+    size = f.get('filesize') or f.get('filesize_approx')
+    if size:
+        return int(size)
+    bitrate = f.get('tbr') or ((f.get('vbr') or 0) + (f.get('abr') or 0))
+    if bitrate and duration:
+        return int(bitrate * 1000 / 8 * duration)
+    return 0
+
+def build_format_index(info):
+    """Index video formats by (codec, height, fps), keeping the best of each group.
+
+    Each entry carries a size estimate that includes the audio it would be
+    merged with, and whether getting a playable file needs a merge at all.
+    """
+    duration = info.get('duration') or 0
+    best_audio = {}
+    index = {}
+    for f in info.get('formats', []):
+        # Only a literal 'none' means audio-only; a missing vcodec is just unknown
+        vcodec = f.get('vcodec')
+        acodec = f.get('acodec') or 'none'
+        family = CONTAINER_FAMILIES.get(f.get('ext'), f.get('ext'))
+        if vcodec == 'none':
+            if acodec == 'none':
+                continue
+            current = best_audio.get(family)
+            if current is None or (f.get('abr') or f.get('tbr') or 0) > (current.get('abr') or current.get('tbr') or 0):
+                best_audio[family] = f
+            continue
+        if not f.get('height'):
+            continue
+
+        key = (codec_family(vcodec), f['height'], int(f.get('fps') or 30))
+        current = index.get(key)
+        # Within a group prefer pre-muxed formats, then the higher bitrate
+        rank = (acodec != 'none', f.get('tbr') or 0)
+        if current is None or rank > current['rank']:
+            index[key] = {'format': f, 'rank': rank}
+
+    fallback_audio = max(best_audio.values(), key=lambda a: a.get('abr') or a.get('tbr') or 0, default=None)
+
+    entries = []
+    for (codec, height, fps), item in index.items():
+        f = item['format']
+        family = CONTAINER_FAMILIES.get(f.get('ext'), f.get('ext'))
+        premuxed = (f.get('acodec') or 'none') != 'none'
+        audio = None if premuxed else best_audio.get(family) or fallback_audio
+        video_size = estimate_format_size(f, duration)
+        audio_size = estimate_format_size(audio, duration) if audio else 0
+        entries.append({
+            'format_id': f['format_id'],
+            'codec': codec,
+            'height': height,
+            'fps': fps,
+            'ext': f.get('ext', ''),
+            'vcodec': f.get('vcodec') or '',
+            'premuxed': premuxed,
+            'audio_format_id': audio['format_id'] if audio else None,
+            'needs_merge': not premuxed and audio is not None,
+            # Streams from the output container family are copied without any conversion
+            'container_match': family == MERGE_CONTAINER and (audio is None or CONTAINER_FAMILIES.get(audio.get('ext')) == family),
+            'video_size': video_size,
+            'audio_size': audio_size,
+            'estimated_size': video_size + audio_size,
+        })
+    return entries
+
+def format_preference(entry):
+    playability = CODEC_PLAYABILITY.index(entry['codec']) if entry['codec'] in CODEC_PLAYABILITY else len(CODEC_PLAYABILITY)
+    # Smaller known sizes win; an unknown size (0) ranks below every known one
+    return (not entry['needs_merge'], entry['container_match'], -playability, -(entry['estimated_size'] or float('inf')))
+
+def build_format_spec(format_id, audio_format_id=None):
+    """yt-dlp selector for a chosen video format, pairing it with container-matched audio."""
+    if audio_format_id:
+        return f'{format_id}+{audio_format_id}/{format_id}+bestaudio/best'
+    return (
+        f'{format_id}[acodec=none][ext=mp4]+bestaudio[ext=m4a]/'
+        f'{format_id}[acodec=none][ext=webm]+bestaudio[ext=webm]/'
+        f'{format_id}[acodec=none]+bestaudio/'
+        f'{format_id}/best'
+    )
+
 @app.post("/api/get-video-info")
 def get_video_info(url: str = Form(...)):
     try:
@@ -503,55 +1338,61 @@ def get_video_info(url: str = Form(...)):
             logger.info(f"Fetching video info for: {url}")
             info = ydl.extract_info(url, download=False)
             
-            # Filter and sort raw formats by quality (resolution, framerate, and filesize)
-            raw_formats = []
-            for f in info.get('formats', []):
-                # Skip audio-only formats and formats without video
-                vcodec = f.get('vcodec', '')
-                if vcodec == 'none' or vcodec == '' or not f.get('height'):
-                    continue
-                raw_formats.append(f)
-
-            # Sort raw formats so that best quality comes first (height desc, fps desc, filesize desc)
-            def get_sort_key(f):
-                h = f.get('height', 0) or 0
-                fps = f.get('fps', 30) or 30
-                size = f.get('filesize') or f.get('filesize_approx') or 0
-                return (h, fps, size)
-
-            raw_formats.sort(key=get_sort_key, reverse=True)
-
-            # Deduplicate by resolution + fps, keeping the highest quality version
+            duration = info.get('duration', 0)
+
+            # Group variants of the same resolution and frame rate, best pick first
+            groups = {}
+            for entry in build_format_index(info):
+                groups.setdefault((entry['height'], entry['fps']), []).append(entry)
+
             formats = []
-            seen_resolutions = set()
-            for f in raw_formats:
-                height = f.get('height', 0)
-                fps = f.get('fps', 30) or 30
+            for (height, fps) in sorted(groups, reverse=True):
+                variants = sorted(groups[(height, fps)], key=format_preference, reverse=True)
+                best = variants[0]
                 resolution = f"{height}p"
                 if fps > 30:
-                    resolution += f" {int(fps)}fps"
-                
-                resolution_key = f"{height}_{int(fps)}"
-                if resolution_key not in seen_resolutions:
-                    seen_resolutions.add(resolution_key)
-                    filesize = f.get('filesize') or f.get('filesize_approx') or 0
-                    formats.append({
-                        'format_id': f['format_id'],
-                        'resolution': resolution,
-                        'filesize_approx': filesize,
-                        'vcodec': f.get('vcodec', ''),
-                        'fps': fps,
-                    })
-            
-            # Get duration in seconds
-            duration = info.get('duration', 0)
-            
+                    resolution += f" {fps}fps"
+                formats.append({
+                    'format_id': best['format_id'],
+                    'resolution': resolution,
+                    # Video plus the audio it will be merged with
+                    'filesize_approx': best['estimated_size'],
+                    'vcodec': best['vcodec'],
+                    'fps': fps,
+                    'codec': best['codec'],
+                    'ext': best['ext'],
+                    'audio_format_id': best['audio_format_id'],
+                    'needs_merge': best['needs_merge'],
+                    'container_match': best['container_match'],
+                    'alternatives': [
+                        {
+                            'format_id': v['format_id'],
+                            'codec': v['codec'],
+                            'ext': v['ext'],
+                            'audio_format_id': v['audio_format_id'],
+                            'filesize_approx': v['estimated_size'],
+                            'needs_merge': v['needs_merge'],
+                            'container_match': v['container_match'],
+                        }
+                        for v in variants[1:]
+                    ],
+                })
+
+            # Fastest path to a playable file among the highest resolutions on offer
+            recommended = None
+            if groups:
+                top = max(groups)
+                recommended = max(groups[top], key=format_preference)['format_id']
+            codecs = {entry['codec'] for entries in groups.values() for entry in entries}
+
             logger.info(f"Found {len(formats)} video formats for: {info.get('title', '')}")
             
             return {
                 'title': info.get('title', ''),
                 'thumbnail': info.get('thumbnail', ''),
                 'formats': formats,
+                'recommended_format_id': recommended,
+                'codec_hints': {codec: CODEC_HINTS[codec] for codec in codecs if codec in CODEC_HINTS},
                 'duration': duration
             }
             
@@ -559,13 +1400,102 @@ def get_video_info(url: str = Form(...)):
         logger.error(f"Error in get_video_info: {str(e)}\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Audio-only download targets. 'selector' prefers a source that can be stored
+# in the target container without re-encoding; 'copy_codecs' are the source
+# codecs for which a plain remux (or no ffmpeg at all) is enough.
+AUDIO_FORMATS = {
+    'mp3': {
+        'selector': 'bestaudio[acodec=mp3]/bestaudio/best',
+        'copy_codecs': ('mp3',),
+        'encoder': 'libmp3lame',
+    },
+    'm4a': {
+        'selector': 'bestaudio[ext=m4a]/bestaudio[acodec^=mp4a]/bestaudio/best',
+        'copy_codecs': ('mp4a', 'aac'),
+        'encoder': 'aac',
+    },
+    'opus': {
+        'selector': 'bestaudio[acodec=opus]/bestaudio/best',
+        'copy_codecs': ('opus',),
+        'encoder': 'libopus',
+    },
+    'webm': {
+        'selector': 'bestaudio[ext=webm]/bestaudio[acodec=opus]/bestaudio/best',
+        'copy_codecs': ('opus', 'vorbis'),
+        'encoder': 'libopus',
+    },
+}
+MIN_AUDIO_BITRATE = 32
+MAX_AUDIO_BITRATE = 512
+
+# Transcodes are CPU bound, so they share a small pool sized from the core count
+FFMPEG_WORKERS = int(os.getenv("FFMPEG_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+transcode_pool = ThreadPoolExecutor(max_workers=FFMPEG_WORKERS, thread_name_prefix="ffmpeg")
+
+def run_ffmpeg(src, dst, codec_args):
+    ffmpeg = shutil.which("ffmpeg")
+    if not ffmpeg:
+        raise RuntimeError("ffmpeg is not installed")
+    cmd = [ffmpeg, '-hide_banner', '-loglevel', 'error', '-y', '-i', str(src), '-vn', *codec_args, str(dst)]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.strip()[-500:]}")
+
+def process_audio_download(src, audio_format, bitrate, source_codec, source_vcodec):
+    """Bring a downloaded audio file into the requested container.
+
+    Returns (path, transcoded). Matching codecs are remuxed (or left alone when
+    the file is audio-only in the right container); anything else is
+    transcoded on the pool. ffmpeg always drops any video stream.
+    """
+    spec = AUDIO_FORMATS[audio_format]
+    dst = src.with_suffix(f'.{audio_format}')
+    source_codec = (source_codec or '').lower()
+    can_copy = any(source_codec.startswith(codec) for codec in spec['copy_codecs'])
+
+    # The selector can fall back to a muxed video, which must go through ffmpeg -vn
+    audio_only_source = source_vcodec == 'none'
+    if can_copy and audio_only_source and src.suffix.lower() == dst.suffix:
+        logger.info(f"Audio already {source_codec} in .{audio_format}, skipping ffmpeg")
+        return src, False
+
+    # Write beside the destination first, since src and dst can be the same file
+    tmp = dst.with_name(f"{dst.stem}.tmp{dst.suffix}")
+    if can_copy:
+        logger.info(f"Remuxing {source_codec} audio into .{audio_format}")
+        run_ffmpeg(src, tmp, ['-c:a', 'copy'])
+    else:
+        logger.info(f"Transcoding {source_codec or 'unknown'} audio to {spec['encoder']} at {bitrate}k")
+        transcode_pool.submit(run_ffmpeg, src, tmp, ['-c:a', spec['encoder'], '-b:a', f'{bitrate}k']).result()
+
+    os.replace(tmp, dst)
+    if src != dst:
+        src.unlink(missing_ok=True)
+    return dst, not can_copy
+
 @app.post("/api/download-video")
 def download_video(
     url: str = Form(...),
     format_id: str = Form(None),
     audio_only: bool = Form(False),
-    format: str = Form("mp4")
+    audio_format_id: str = Form(None),  # audio to merge with format_id, as suggested by get-video-info
+    format: str = Form("mp4"),  # audio container when audio_only: 'mp3', 'm4a', 'opus' or 'webm'
+    audio_bitrate: int = Form(320)  # kbps, only used when the audio has to be transcoded
 ):
+    audio_format = format.lower() if audio_only else None
+    if audio_only:
+        if audio_format == 'mp4':
+            # Older clients leave the video default in place for audio downloads
+            audio_format = 'mp3'
+        if audio_format not in AUDIO_FORMATS:
+            raise HTTPException(status_code=400, detail=f"Unsupported audio format: {format}")
+        if not MIN_AUDIO_BITRATE <= audio_bitrate <= MAX_AUDIO_BITRATE:
+            raise HTTPException(status_code=400, detail=f"audio_bitrate must be between {MIN_AUDIO_BITRATE} and {MAX_AUDIO_BITRATE}")
+
+    with admission.blocking_slot("/api/download-video"):
+        return run_video_download(url, format_id, audio_only, audio_format_id, audio_format, audio_bitrate)
+
+def run_video_download(url, format_id, audio_only, audio_format_id, audio_format, audio_bitrate):
     try:
         # Clean up any existing downloads
         for file in DOWNLOAD_DIR.glob("*"):
@@ -629,14 +1559,11 @@ def download_video(
         
         # Configure yt-dlp options based on whether audio_only is selected
         if audio_only:
+            # No yt-dlp postprocessor: process_audio_download decides between
+            # keeping, remuxing or transcoding once the source codec is known
             ydl_opts = {
                 **base_opts,
-                'format': 'bestaudio/best',
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '320',
-                }],
+                'format': AUDIO_FORMATS[audio_format]['selector'],
                 # Skip unnecessary steps
                 'updatetime': False,
                 'writeinfojson': False,
@@ -644,11 +1571,11 @@ def download_video(
                 'writethumbnail': False,
                 'writesubtitles': False,
             }
-            logger.info("Downloading audio only (MP3)")
+            logger.info(f"Downloading audio only ({audio_format})")
         else:
             # For video, always include audio and use specific format
             if format_id:
-                format_spec = f'{format_id}+bestaudio/best'
+                format_spec = build_format_spec(format_id, audio_format_id)
             else:
                 format_spec = 'bestvideo+bestaudio/best'
             
@@ -667,13 +1594,27 @@ def download_video(
             if not info:
                 raise HTTPException(status_code=400, detail="Failed to extract video information or video unavailable")
 
-                        # Get the actual filename by finding the most recent file in downloads
             if audio_only:
-                # For audio-only, find the actual mp3 file
-                media_files = list(DOWNLOAD_DIR.glob('*.mp3'))
-            else:
-                # For video, find mp4 or webm files
-                media_files = list(DOWNLOAD_DIR.glob('*.mp4')) + list(DOWNLOAD_DIR.glob('*.webm'))
+                # yt-dlp reports the file it wrote and the codec of the chosen format
+                requested = (info.get('requested_downloads') or [{}])[0]
+                source_path = Path(requested.get('filepath') or ydl.prepare_filename(info))
+                source_codec = requested.get('acodec') or info.get('acodec')
+                source_vcodec = requested.get('vcodec') or info.get('vcodec')
+                final_file, transcoded = process_audio_download(source_path, audio_format, audio_bitrate, source_codec, source_vcodec)
+                logger.info(f"Audio ready: {final_file.name} (transcoded: {transcoded})")
+                return {
+                    "title": info.get("title"),
+                    "duration": info.get("duration"),
+                    "thumbnail": info.get("thumbnail"),
+                    "download_path": final_file.name,
+                    "audio_format": audio_format,
+                    "source_codec": source_codec,
+                    "transcoded": transcoded
+                }
+
+            # Get the actual filename by finding the most recent file in downloads
+            # For video, find mp4 or webm files
+            media_files = list(DOWNLOAD_DIR.glob('*.mp4')) + list(DOWNLOAD_DIR.glob('*.webm'))
             
             if media_files:
                 # Get the most recently modified file
@@ -683,10 +1624,7 @@ def download_video(
             else:
                 # Fallback: use prepare_filename
                 filename = ydl.prepare_filename(info)
-                if audio_only:
-                    final_filename = Path(filename).with_suffix('.mp3').name
-                else:
-                    final_filename = Path(filename).with_suffix('.mp4').name
+                final_filename = Path(filename).with_suffix('.mp4').name
                 logger.warning(f"No file found in downloads, using expected name: {final_filename}")
             
             return {
@@ -695,6 +1633,8 @@ def download_video(
                 "thumbnail": info.get("thumbnail"),
                 "download_path": final_filename
             }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in download_video: {str(e)}\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -739,7 +1679,7 @@ async def cleanup_old_files():
     """Background task to delete files older than 24 hours."""
     while True:
         now = time.time()
-        for directory in [UPLOAD_DIR, OUTPUT_DIR, DOWNLOAD_DIR]:
+        for directory in [UPLOAD_DIR, CHUNKED_UPLOAD_DIR, OUTPUT_DIR, DOWNLOAD_DIR, MASK_DIR]:
             if not directory.exists():
                 continue
             for file_path in directory.glob("*"):
@@ -752,6 +1692,12 @@ async def cleanup_old_files():
                     except Exception as e:
                         logger.error(f"Failed to delete old file {file_path}: {e}")
         
+        # Forget chunked uploads that went idle or whose data has been cleaned up
+        expire_idle_uploads()
+        with uploads_lock:
+            for upload_id in [uid for uid, upload in chunked_uploads.items() if not upload['path'].exists()]:
+                del chunked_uploads[upload_id]
+
         # Sleep for an hour before checking again
         await asyncio.sleep(3600)
 
@@ -1,11 +1,18 @@
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
+import pytest
 import sys
 import os
+import hashlib
+import io
 
 # Add parent directory to path so we can import main
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from main import app
+from PIL import Image, ImageEnhance, ImageOps
+
+import main
+from main import app, apply_pixel_ops, build_format_index, format_preference, plan_conversion, process_audio_download
 
 client = TestClient(app)
 
@@ -23,3 +30,247 @@ def test_pdf_merge_unconfigured():
     response = client.post("/api/pdf/merge", files=files)
     assert response.status_code == 501
     assert response.json()["detail"] == "Stirling-PDF service not configured"
+
+def test_remove_background_rejects_unknown_output_format():
+    files = [
+        ('files', ('test.png', b'fake png content', 'image/png'))
+    ]
+    response = client.post("/api/remove-background", files=files, data={"output_format": "gif"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Unsupported output format: gif"
+
+def test_remove_background_reuses_cached_mask(monkeypatch):
+    calls = []
+
+    def fake_remove(image, only_mask=False):
+        calls.append(image.size)
+        return Image.new('L', image.size, 255)
+
+    monkeypatch.setattr(main, "remove", fake_remove)
+    # Random pixels so the mask cache cannot already hold this image
+    image = Image.frombytes('RGB', (4, 4), os.urandom(48))
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG')
+    files = [
+        ('files', ('cached.png', buffer.getvalue(), 'image/png'))
+    ]
+
+    first = client.post("/api/remove-background", files=files)
+    assert first.status_code == 200
+    assert first.json()["files"][0]["mask_cached"] is False
+
+    second = client.post("/api/remove-background", files=files, data={"background_color": "#ffffff"})
+    assert second.status_code == 200
+    assert second.json()["files"][0]["mask_cached"] is True
+    assert second.json()["files"][0]["mask_id"] == first.json()["files"][0]["mask_id"]
+    assert len(calls) == 1
+
+def test_plan_conversion_downscales_before_filtering():
+    img = Image.new('RGBA', (400, 300))
+    steps = plan_conversion(img, 'JPEG', 100, None, True, 'blur', 90)
+    ops = [op for op, _ in steps]
+    assert ops == ['thumbnail', 'transpose', 'pixels', 'filter']
+    # Box is given in pre-rotation axes when resizing ahead of a 90 degree turn
+    assert steps[0][1] == (None, 100)
+    assert steps[2][1]['drop_alpha'] is True
+
+def test_plan_conversion_converts_palette_images_before_downscaling():
+    img = Image.new('P', (400, 300))
+    steps = plan_conversion(img, 'PNG', 100, None, True, 'grayscale', 0)
+    assert [op for op, _ in steps] == ['convert', 'thumbnail', 'pixels']
+    assert steps[0][1] == 'RGB'
+
+def test_pixel_ops_match_image_enhance():
+    img = Image.frombytes('RGB', (32, 32), os.urandom(32 * 32 * 3))
+    for brightness, contrast in [(1.3, 1.0), (1.0, 0.6), (0.8, 1.5)]:
+        expected = ImageEnhance.Contrast(ImageEnhance.Brightness(img).enhance(brightness)).enhance(contrast)
+        result = apply_pixel_ops(img, brightness=brightness, contrast=contrast)
+        diff = [abs(a - b) for pa, pb in zip(result.getdata(), expected.getdata()) for a, b in zip(pa, pb)]
+        assert max(diff) <= 2
+
+def test_pixel_ops_grayscale_matches_pillow():
+    img = Image.frombytes('RGBA', (32, 32), os.urandom(32 * 32 * 4))
+    result = apply_pixel_ops(img, grayscale=True)
+    assert result.mode == 'LA'
+    assert list(result.getchannel(0).getdata()) == list(ImageOps.grayscale(img).getdata())
+    assert list(result.getchannel(1).getdata()) == list(img.getchannel('A').getdata())
+
+def test_convert_image_rotates_and_resizes_rgba_to_jpeg():
+    buffer = io.BytesIO()
+    Image.new('RGBA', (40, 20), (255, 0, 0, 128)).save(buffer, 'PNG')
+    files = [
+        ('files', ('wide.png', buffer.getvalue(), 'image/png'))
+    ]
+    response = client.post("/api/convert-image", files=files, data={"format": "jpg", "rotation": 90, "width": 10})
+    assert response.status_code == 200
+    output = client.get(response.json()["files"][0]["url"])
+    with Image.open(io.BytesIO(output.content)) as converted:
+        assert converted.format == 'JPEG'
+        assert converted.mode == 'RGB'
+        assert converted.size == (10, 20)
+
+def test_convert_image_rejects_too_many_files():
+    files = [
+        ('files', (f'test{i}.png', b'fake png content', 'image/png')) for i in range(21)
+    ]
+    response = client.post("/api/convert-image", files=files, data={"format": "png"})
+    assert response.status_code == 413
+    metrics = client.get("/api/admission-metrics").json()
+    assert metrics["/api/convert-image"]["too_large"] >= 1
+
+def test_admission_rate_limits_with_retry_after(monkeypatch):
+    monkeypatch.setattr(main, "get_client_id", lambda request: "rate-limit-test")
+    # Rejected by the handler with a 400, but still spends a token each time
+    data = {"url": "https://example.com/video", "audio_only": "true", "format": "gif"}
+    for _ in range(main.ADMISSION_LIMITS["/api/download-video"]["burst"]):
+        assert client.post("/api/download-video", data=data).status_code == 400
+    response = client.post("/api/download-video", data=data)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+
+def test_admission_requires_content_length():
+    response = client.post("/api/download-video", content=iter([b"url=x"]), headers={"Content-Type": "application/x-www-form-urlencoded"})
+    assert response.status_code == 411
+
+def test_admission_rejects_declared_oversize_body():
+    declared = main.ADMISSION_LIMITS["/api/download-video"]["max_body_bytes"] + 1
+    response = client.post("/api/download-video", content=b"url=x", headers={"Content-Length": str(declared)})
+    assert response.status_code == 413
+
+def test_admission_sheds_when_queue_is_full():
+    limits = {"/api/test": {"rate_per_minute": 60, "burst": 1, "concurrency": 1, "max_queue": 0, "max_body_bytes": 1024, "max_files": 1}}
+    controller = main.AdmissionController(limits)
+    controller.reserve("/api/test")
+    controller.start("/api/test")
+    with pytest.raises(HTTPException) as excinfo:
+        controller.reserve("/api/test")
+    assert excinfo.value.status_code == 503
+    assert excinfo.value.headers["Retry-After"] == str(main.OVERLOADED_RETRY_AFTER_SECONDS)
+    assert controller.snapshot()["/api/test"]["overloaded"] == 1
+
+def test_chunked_upload_resumes_after_bad_chunk():
+    chunk_size = main.MIN_CHUNK_SIZE
+    data = os.urandom(chunk_size + 16)
+    upload = client.post("/api/uploads", data={"filename": "doc.pdf", "size": len(data), "chunk_size": chunk_size}).json()
+    assert upload["total_chunks"] == 2
+    assert upload["missing_chunks"] == [[0, 1]]
+    upload_url = f"/api/uploads/{upload['upload_id']}"
+
+    first, second = data[:chunk_size], data[chunk_size:]
+    response = client.put(f"{upload_url}/chunks/0", content=first, headers={"X-Chunk-SHA256": hashlib.sha256(b'corrupt').hexdigest()})
+    assert response.status_code == 422
+    response = client.put(f"{upload_url}/chunks/1", content=second, headers={"X-Chunk-SHA256": hashlib.sha256(second).hexdigest()})
+    assert response.status_code == 200
+    assert client.get(upload_url).json()["missing_chunks"] == [[0, 0]]
+
+    response = client.put(f"{upload_url}/chunks/0", content=first, headers={"X-Chunk-SHA256": hashlib.sha256(first).hexdigest()})
+    assert response.status_code == 200
+    response = client.post(f"{upload_url}/complete", data={"sha256": hashlib.sha256(data).hexdigest()})
+    assert response.status_code == 200
+    assert response.json()["complete"] is True
+    assert client.delete(upload_url).status_code == 200
+
+def test_completed_upload_feeds_several_conversions():
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8), (0, 128, 255)).save(buffer, 'PNG')
+    data = buffer.getvalue()
+    upload = client.post("/api/uploads", data={"filename": "photo.png", "size": len(data), "chunk_size": main.MIN_CHUNK_SIZE}).json()
+    upload_url = f"/api/uploads/{upload['upload_id']}"
+
+    response = client.post("/api/convert-image", data={"format": "webp", "upload_ids": [upload["upload_id"]]})
+    assert response.status_code == 409
+
+    response = client.put(f"{upload_url}/chunks/0", content=data, headers={"X-Chunk-SHA256": hashlib.sha256(data).hexdigest()})
+    assert response.status_code == 200
+    assert client.post(f"{upload_url}/complete").status_code == 200
+
+    for fmt in ("webp", "jpg"):
+        response = client.post("/api/convert-image", data={"format": fmt, "upload_ids": [upload["upload_id"]]})
+        assert response.status_code == 200
+        assert response.json()["files"][0]["filename"] == f"converted_photo.{fmt}"
+    assert client.delete(upload_url).status_code == 200
+
+def test_chunked_uploads_are_capped_per_client(monkeypatch):
+    monkeypatch.setattr(main, "get_client_id", lambda request: "upload-cap-test")
+    form = {"filename": "doc.pdf", "size": 1024, "chunk_size": main.MIN_CHUNK_SIZE}
+    upload_ids = []
+    for _ in range(main.MAX_CHUNKED_UPLOADS_PER_CLIENT):
+        response = client.post("/api/uploads", data=form)
+        assert response.status_code == 200
+        upload_ids.append(response.json()["upload_id"])
+    response = client.post("/api/uploads", data=form)
+    assert response.status_code == 429
+    assert "Retry-After" in response.headers
+    for upload_id in upload_ids:
+        client.delete(f"/api/uploads/{upload_id}")
+
+def test_idle_chunked_uploads_expire(monkeypatch):
+    upload = client.post("/api/uploads", data={"filename": "doc.pdf", "size": 1024, "chunk_size": main.MIN_CHUNK_SIZE}).json()
+    monkeypatch.setattr(main, "CHUNKED_UPLOAD_IDLE_SECONDS", -1)
+    assert client.get(f"/api/uploads/{upload['upload_id']}").status_code == 404
+    assert not (main.CHUNKED_UPLOAD_DIR / upload["upload_id"]).exists()
+
+def test_chunked_upload_rejects_tiny_chunks():
+    response = client.post("/api/uploads", data={"filename": "big.pdf", "size": 2 * 1024 * 1024 * 1024, "chunk_size": 1})
+    assert response.status_code == 400
+
+def test_audio_download_skips_ffmpeg_when_container_matches(tmp_path):
+    source = tmp_path / "song.m4a"
+    source.write_bytes(b'fake aac audio')
+    path, transcoded = process_audio_download(source, 'm4a', 192, 'mp4a.40.2', 'none')
+    assert path == source
+    assert transcoded is False
+    assert source.read_bytes() == b'fake aac audio'
+
+def test_format_index_estimates_size_with_matching_audio():
+    info = {
+        'duration': 100,
+        'formats': [
+            {'format_id': '140', 'ext': 'm4a', 'vcodec': 'none', 'acodec': 'mp4a.40.2', 'abr': 128},
+            {'format_id': '251', 'ext': 'webm', 'vcodec': 'none', 'acodec': 'opus', 'abr': 160},
+            {'format_id': '137', 'ext': 'mp4', 'vcodec': 'avc1.640028', 'acodec': 'none', 'height': 1080, 'fps': 30, 'tbr': 4000},
+            {'format_id': '248', 'ext': 'webm', 'vcodec': 'vp9', 'acodec': 'none', 'height': 1080, 'fps': 30, 'tbr': 2500},
+        ],
+    }
+    entries = {entry['format_id']: entry for entry in build_format_index(info)}
+    h264 = entries['137']
+    assert h264['codec'] == 'h264'
+    assert h264['audio_format_id'] == '140'
+    assert h264['container_match'] is True
+    assert h264['estimated_size'] == 4000 * 1000 // 8 * 100 + 128 * 1000 // 8 * 100
+    assert entries['248']['audio_format_id'] == '251'
+    assert entries['248']['container_match'] is False
+
+def test_audio_download_remuxes_muxed_video_source(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(main, "run_ffmpeg", lambda src, dst, codec_args: (calls.append(codec_args), dst.write_bytes(b'audio')))
+    source = tmp_path / "clip.webm"
+    source.write_bytes(b'fake vp9 and opus')
+    path, transcoded = process_audio_download(source, 'webm', 192, 'opus', 'vp9')
+    assert calls == [['-c:a', 'copy']]
+    assert path == source
+    assert transcoded is False
+    assert source.read_bytes() == b'audio'
+
+def test_format_index_keeps_formats_with_unknown_codecs():
+    info = {
+        'duration': 10,
+        'formats': [
+            {'format_id': 'hls-720', 'ext': 'mp4', 'vcodec': None, 'acodec': None, 'height': 720, 'tbr': 2000},
+        ],
+    }
+    entries = build_format_index(info)
+    assert len(entries) == 1
+    assert entries[0]['format_id'] == 'hls-720'
+    assert entries[0]['codec'] == 'unknown'
+    assert entries[0]['estimated_size'] == 2000 * 1000 // 8 * 10
+
+def test_format_preference_ranks_unknown_size_last():
+    base = {'codec': 'h264', 'needs_merge': True, 'container_match': True}
+    entries = [
+        {**base, 'format_id': 'unknown', 'estimated_size': 0},
+        {**base, 'format_id': 'large', 'estimated_size': 9000000},
+        {**base, 'format_id': 'small', 'estimated_size': 5000000},
+    ]
+    ranked = sorted(entries, key=format_preference, reverse=True)
+    assert [entry['format_id'] for entry in ranked] == ['small', 'large', 'unknown']